@@ -1,18 +1,25 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
 from fastapi.middleware.cors import CORSMiddleware
-import json
+import msgspec
+import orjson
 import random
 import asyncio
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Set
 import os
-from threading import Lock
+import sys
+import time
+from threading import RLock
+from collections import defaultdict
+from types import MappingProxyType
+from contextlib import asynccontextmanager
+from functools import lru_cache
 
 # Load JSON data
 def load_json_data(filename: str) -> Dict:
     """Load JSON data from file"""
     try:
-        with open(filename, 'r') as f:
-            return json.load(f)
+        with open(filename, 'rb') as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         print(f"Warning: {filename} not found, using fallback data")
         return {}
@@ -21,8 +28,22 @@ def load_json_data(filename: str) -> Dict:
 SPELL_DATA = load_json_data('class_spells_level_1_to_20.json')
 WEAPON_DATA = load_json_data('class_weapon_progression_by_level.json')
 PASSIVE_DATA = load_json_data('class_passives_by_level.json')
+ENCOUNTERS = load_json_data('encounters.json')
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    stop_flusher = asyncio.Event()
+    flusher = asyncio.create_task(flush_rooms(stop_flusher))
+    yield
+    # Let a write already running in its thread finish before the final save;
+    # cancelling would leave it racing save_rooms() on the same temp file
+    stop_flusher.set()
+    await flusher
+    # Write out whatever changed since the last flush
+    if rooms_dirty:
+        save_rooms()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -37,22 +58,138 @@ app.add_middleware(
 games: Dict[str, Dict] = {}
 SAVE_DIR = 'saves'
 ROOMS_FILE = 'rooms.json'
-room_lock = Lock()
+# Board is GRID_SIZE x GRID_SIZE, stored flat in row-major order (0 = empty cell)
+GRID_SIZE = 6
+GRID_MAX = GRID_SIZE - 1
+EMPTY_GRID = (0,) * (GRID_SIZE * GRID_SIZE)
+# Movement deltas (dx, dy) applied to [x, y] positions
+MOVES = {"up": (0, -1), "down": (0, 1), "left": (-1, 0), "right": (1, 0)}
+room_lock = RLock()
+
+class PlayerData(msgspec.Struct):
+    """Character sheet, persisted in save files and rooms.json"""
+    name: str
+    player_class: str
+    subclass: str
+    level: int = 1
+    spells: List[str] = []
+    weapon: str = "Dagger"
+    inventory: List[Dict] = []
+    gold: int = 0
+    save_slot: int = 1
+    xp: int = 0
+    ac: int = 10
+    attributes: Dict[str, int] = {}
+    passive: str = "None"
+    hp: int = 10
+    max_hp: int = 10
+
+class Enemy(msgspec.Struct):
+    """An enemy in the current encounter"""
+    name: str
+    type: str
+    hp: int
+    max_hp: int
+    damage: int
+    ac: int
+    position: List[int]
+
+class GameState(msgspec.Struct):
+    """Shared state of a room, persisted in rooms.json"""
+    turn: Optional[str] = None
+    turn_idx: int = 0
+    phase: str = "setup"
+    grid: List[int] = msgspec.field(default_factory=lambda: list(EMPTY_GRID))
+    player_positions: Dict[str, List[int]] = {}
+    enemies: Dict[str, Enemy] = {}
+    player_hp: Dict[str, int] = {}
+    inventory: Dict[str, List[Dict]] = {}
+    spells: Dict[str, List[str]] = {}
+    gold: Dict[str, int] = {}
+    level: Dict[str, int] = {}
+    xp: Dict[str, int] = {}
+    shop_items: Dict[str, Dict] = {}
+    loot_pool: Dict[str, Dict] = {}
+    encounter_number: int = 0
+    winner: Optional[str] = None
 
 # Ensure save directory exists
 if not os.path.exists(SAVE_DIR):
     os.makedirs(SAVE_DIR)
 
-def save_rooms():
+# Room changes are flushed to ROOMS_FILE at most once per SAVE_INTERVAL seconds
+SAVE_INTERVAL = 0.5
+rooms_dirty = False
+# Players per room whose hp/inventory/gold/xp changed since their save file was written
+dirty_players: Dict[str, Set[str]] = defaultdict(set)
+
+def dump_rooms() -> bytes:
+    """Serialize all rooms for ROOMS_FILE"""
     with room_lock:
-        with open(ROOMS_FILE, 'w') as f:
-            json.dump(games, f, indent=2)
+        return orjson.dumps(games, default=msgspec.to_builtins, option=orjson.OPT_INDENT_2)
+
+def write_file_atomic(path: str, data: bytes):
+    """Write data to path via a temp file so a crash never leaves a torn file"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def write_rooms(data: bytes):
+    """Write serialized rooms to ROOMS_FILE"""
+    write_file_atomic(ROOMS_FILE, data)
+
+def save_rooms():
+    global rooms_dirty
+    rooms_dirty = False
+    write_rooms(dump_rooms())
+
+def mark_rooms_dirty():
+    """Schedule rooms to be written by the next flush"""
+    global rooms_dirty
+    rooms_dirty = True
+
+async def flush_rooms(stop: asyncio.Event):
+    """Background task writing dirty rooms to disk until stop is set"""
+    global rooms_dirty
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), SAVE_INTERVAL)
+            break
+        except asyncio.TimeoutError:
+            pass
+        if rooms_dirty:
+            rooms_dirty = False
+            # Serialize on the loop so state cannot change mid-dump, write in a thread
+            data = dump_rooms()
+            await asyncio.to_thread(write_rooms, data)
 
 def load_rooms():
     global games
     if os.path.exists(ROOMS_FILE):
-        with open(ROOMS_FILE, 'r') as f:
-            games = json.load(f)
+        with open(ROOMS_FILE, 'rb') as f:
+            games = orjson.loads(f.read())
+        # Older saves stored the grid as nested lists of None
+        for room_id, room in games.items():
+            grid = room["state"].get("grid")
+            if grid and isinstance(grid[0], list):
+                room["state"]["grid"] = list(EMPTY_GRID)
+            # Older saves tracked the turn by player name only
+            if "turn_idx" not in room["state"]:
+                turn = room["state"]["turn"]
+                order = room["player_order"]
+                room["state"]["turn_idx"] = order.index(turn) if turn in order else 0
+            # Older saves stored shop items and loot as lists
+            for key in ("shop_items", "loot_pool"):
+                items = room["state"].get(key)
+                if isinstance(items, list):
+                    room["state"][key] = {item["name"]: item for item in items}
+            room["players"] = {
+                name: msgspec.convert(data, PlayerData) for name, data in room["players"].items()
+            }
+            room["state"] = msgspec.convert(room["state"], GameState)
+            # Progress made before the restart may not have reached the save files
+            dirty_players[room_id].update(room["player_order"])
     else:
         games = {}
     print(f"Server started with {len(games)} rooms loaded")
@@ -62,28 +199,176 @@ load_rooms()
 
 MAIN_ROOM_ID = "room_main"
 
+# WebSocket wire codecs: msgpack by default, JSON for legacy clients (?format=json)
+msgpack_encoder = msgspec.msgpack.Encoder()
+msgpack_decoder = msgspec.msgpack.Decoder()
+
+def encode_message(message: Dict, wire_format: str):
+    """Encode a message for a client's wire format"""
+    if wire_format == "json":
+        return orjson.dumps(message, default=msgspec.to_builtins).decode()
+    if "grid" in message:
+        # One byte per cell: msgpack sends it as a single bin blob, not a nested array
+        message = dict(message, grid=bytes(message["grid"]))
+    return msgpack_encoder.encode(message)
+
+async def send_encoded(websocket: WebSocket, payload):
+    """Send an already encoded message"""
+    if isinstance(payload, str):
+        await websocket.send_text(payload)
+    else:
+        await websocket.send_bytes(payload)
+
+# Frames buffered per connection before its backlog is replaced by a full_state
+SEND_QUEUE_SIZE = 32
+
+class Channel:
+    """Outbound queue for one connection, drained by its own relay task"""
+    def __init__(self, websocket: WebSocket, wire_format: str):
+        self.websocket = websocket
+        self.wire_format = wire_format
+        self.queue: asyncio.Queue = asyncio.Queue(SEND_QUEUE_SIZE)
+        self.relay_task = asyncio.create_task(self.relay())
+
+    async def relay(self):
+        """Send queued frames in order; stops at the first failed send"""
+        while True:
+            payload = await self.queue.get()
+            try:
+                await send_encoded(self.websocket, payload)
+            except Exception:
+                return
+
+    def send(self, payload) -> bool:
+        """Queue an encoded frame without waiting, False if the queue is full"""
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    def resync(self, payload):
+        """Replace every queued frame with one encoded full_state"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(payload)
+
+    def close(self):
+        """Stop relaying"""
+        self.relay_task.cancel()
+
+# Per-socket limits so one client cannot monopolize the event loop
+MAX_MESSAGE_SIZE = 16384
+ACTION_RATE = 20  # actions per second
+ACTION_BURST = 40
+
+class TokenBucket:
+    """Token bucket rate limiter for a single connection"""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def receive_message(websocket: WebSocket, wire_format: str) -> Optional[Dict]:
+    """Receive a message from a client in its wire format, None if it is too large or malformed"""
+    try:
+        if wire_format == "json":
+            data = await websocket.receive_text()
+        else:
+            data = await websocket.receive_bytes()
+    except KeyError:
+        # Text frame on a msgpack socket or binary frame on a JSON socket
+        return None
+    if len(data) > MAX_MESSAGE_SIZE:
+        return None
+    try:
+        if wire_format == "json":
+            message = orjson.loads(data)
+        else:
+            message = msgpack_decoder.decode(data)
+    except (orjson.JSONDecodeError, msgspec.DecodeError):
+        return None
+    if not isinstance(message, dict):
+        return None
+    return message
+
+# Open WebSocket connections per room
+connections: Dict[str, Set[Channel]] = {}
+# Per-room locks so each action is applied and broadcast before the next one
+room_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+# Per-room state version, bumped for every delta so clients can detect a missed
+# one; a client that sees a gap sends {"sync": true} to get a fresh full_state
+room_versions: Dict[str, int] = defaultdict(int)
+
+# State keys touched when a player joins or leaves the room
+ROSTER_KEYS = ("players", "player_order", "turn", "turn_idx", "player_hp", "inventory", "spells", "gold", "level", "xp")
+
+def full_state(room_id: str) -> Dict:
+    """Build the full state message for a room"""
+    state = msgspec.structs.asdict(games[room_id]["state"])
+    state["players"] = games[room_id]["players"]
+    state["player_order"] = games[room_id]["player_order"]
+    state["type"] = "full_state"
+    state["v"] = room_versions[room_id]
+    return state
+
+def state_delta(room_id: str, changed, last_action: Optional[Dict] = None) -> Dict:
+    """Build the next delta message, carrying only the changed top-level state keys"""
+    room = games[room_id]
+    # broadcast() commits the new version once the delta has been encoded
+    delta = {"type": "delta", "v": room_versions[room_id] + 1}
+    for key in changed:
+        delta[key] = room[key] if key in ("players", "player_order") else getattr(room["state"], key)
+    if last_action is not None:
+        delta["last_action"] = last_action
+    return delta
+
+def broadcast(room_id: str, message: Dict):
+    """Queue a message on every connection in a room, encoding it once per wire format"""
+    channels = []
+    for channel in list(connections.get(room_id, ())):
+        if channel.relay_task.done():
+            # Its socket failed a send; the handler's cleanup removes the player
+            connections[room_id].discard(channel)
+        else:
+            channels.append(channel)
+    # Encode for every format before queuing anything, so an encoding error
+    # cannot leave some peers with the update and others without it
+    payloads = {
+        wire_format: encode_message(message, wire_format)
+        for wire_format in {channel.wire_format for channel in channels}
+    }
+    if "v" in message:
+        room_versions[room_id] = message["v"]
+    snapshots = {}
+    for channel in channels:
+        wire_format = channel.wire_format
+        # Never waits on a slow peer: one that is too far behind gets a fresh
+        # full_state in place of its backlog instead of being disconnected
+        if not channel.send(payloads[wire_format]):
+            if wire_format not in snapshots:
+                snapshots[wire_format] = encode_message(full_state(room_id), wire_format)
+            channel.resync(snapshots[wire_format])
+
 def ensure_main_room():
     with room_lock:
         if MAIN_ROOM_ID not in games:
             games[MAIN_ROOM_ID] = {
                 "players": {},
                 "player_order": [],
-                "state": {
-                    "turn": None,
-                    "phase": "setup",
-                    "grid": [[None for _ in range(6)] for _ in range(6)],
-                    "player_positions": {},
-                    "enemies": {},
-                    "player_hp": {},
-                    "inventory": {},
-                    "spells": {},
-                    "gold": {},
-                    "level": {},
-                    "xp": {},
-                    "shop_items": [],
-                    "loot_pool": [],
-                    "encounter_number": 0
-                }
+                "state": GameState()
             }
             save_rooms()
             print(f"Main room '{MAIN_ROOM_ID}' created and ready.")
@@ -91,46 +376,64 @@ def ensure_main_room():
 # After loading rooms on startup
 ensure_main_room()
 
-def load_player_data(player_name: str, save_slot: int) -> Optional[Dict]:
+@lru_cache(maxsize=256)
+def parse_save_file(save_path: str, inode: int, mtime_ns: int) -> Dict:
+    """Parse a save file, cached until the file is replaced or modified"""
+    # Callers share the cached dict and must not mutate it
+    with open(save_path, 'rb') as f:
+        return orjson.loads(f.read())
+
+def read_save_file(save_path: str) -> Dict:
+    """Read a save file through the parse cache"""
+    stat = os.stat(save_path)
+    return parse_save_file(save_path, stat.st_ino, stat.st_mtime_ns)
+
+def load_player_data(player_name: str, save_slot: int) -> Optional[PlayerData]:
     """Load player data from save file"""
     save_path = os.path.join(SAVE_DIR, f'save{save_slot}_{player_name}.json')
     if os.path.exists(save_path):
         try:
-            with open(save_path, 'r') as f:
-                return json.load(f)
+            # convert() builds fresh containers, so the cached dict stays untouched
+            return msgspec.convert(read_save_file(save_path), PlayerData)
         except:
             return None
     return None
 
-def save_player_data(player_name: str, save_slot: int, player_data: Dict):
+def save_player_data(player_name: str, save_slot: int, player_data: PlayerData):
     """Save player data to file"""
     save_path = os.path.join(SAVE_DIR, f'save{save_slot}_{player_name}.json')
-    with open(save_path, 'w') as f:
-        json.dump(player_data, f, indent=2)
+    write_file_atomic(save_path, orjson.dumps(player_data, default=msgspec.to_builtins, option=orjson.OPT_INDENT_2))
 
-def create_new_player(name: str, player_class: str, subclass: str, save_slot: int) -> Dict:
-    """Create a new player with default stats using JSON data"""
-    # Standard array: 15, 14, 13, 12
-    class_stat_priorities = {
-        'Warrior': ['Str', 'Con', 'Wis', 'Int'],
-        'Paladin': ['Con', 'Str', 'Wis', 'Int'],
-        'Cleric': ['Wis', 'Con', 'Str', 'Int'],
-        'Priest': ['Wis', 'Int', 'Con', 'Str'],
-        'Mage': ['Int', 'Wis', 'Con', 'Str'],
-        'Ranger': ['Str', 'Con', 'Wis', 'Int'],
-    }
-    
-    standard_array = [15, 14, 13, 12]
-    priorities = class_stat_priorities.get(player_class, ['Str', 'Con', 'Wis', 'Int'])
-    attributes = {}
-    for i, attr in enumerate(priorities):
-        attributes[attr] = standard_array[i]
-    
+# Standard array: 15, 14, 13, 12, assigned in each class's stat priority order
+STANDARD_ARRAY = (15, 14, 13, 12)
+DEFAULT_STAT_PRIORITIES = ('Str', 'Con', 'Wis', 'Int')
+CLASS_STAT_PRIORITIES = MappingProxyType({
+    'Warrior': ('Str', 'Con', 'Wis', 'Int'),
+    'Paladin': ('Con', 'Str', 'Wis', 'Int'),
+    'Cleric': ('Wis', 'Con', 'Str', 'Int'),
+    'Priest': ('Wis', 'Int', 'Con', 'Str'),
+    'Mage': ('Int', 'Wis', 'Con', 'Str'),
+    'Ranger': ('Str', 'Con', 'Wis', 'Int'),
+})
+
+def build_starting_attributes(priorities) -> MappingProxyType:
+    """Build a read-only starting attribute table for a stat priority order"""
+    attributes = dict(zip(priorities, STANDARD_ARRAY))
     # Fill missing stats with 10
-    for attr in ['Str', 'Con', 'Wis', 'Int']:
+    for attr in DEFAULT_STAT_PRIORITIES:
         if attr not in attributes:
             attributes[attr] = 10
-    
+    return MappingProxyType(attributes)
+
+# Shared templates, copied once per new character
+STARTING_ATTRIBUTES = MappingProxyType({
+    player_class: build_starting_attributes(priorities)
+    for player_class, priorities in CLASS_STAT_PRIORITIES.items()
+})
+DEFAULT_STARTING_ATTRIBUTES = build_starting_attributes(DEFAULT_STAT_PRIORITIES)
+
+def build_starting_loadout(player_class: str, subclass: str) -> MappingProxyType:
+    """Build the level 1 spells, weapon and passive for a class and subclass"""
     # Get starting spells from JSON data
     spells = []
     if player_class in SPELL_DATA:
@@ -174,23 +477,41 @@ def create_new_player(name: str, player_class: str, subclass: str, save_slot: in
     if passive is None:
         passive = "None"
     
-    return {
-        'name': name,
-        'player_class': player_class,
-        'subclass': subclass,
-        'level': 1,
-        'spells': spells,
-        'weapon': weapon,
-        'inventory': [],
-        'gold': 0,
-        'save_slot': save_slot,
-        'xp': 0,
-        'ac': 10 + attributes.get('Con', 10),
-        'attributes': attributes,
-        'passive': passive,
-        'hp': 10 + attributes.get('Con', 10),
-        'max_hp': 10 + attributes.get('Con', 10)
-    }
+    return MappingProxyType({'spells': tuple(spells), 'weapon': weapon, 'passive': passive})
+
+# Starting loadouts for every known (class, subclass), built once at import
+STARTING_LOADOUT = MappingProxyType({
+    (player_class, subclass): build_starting_loadout(player_class, subclass)
+    for data in (SPELL_DATA, PASSIVE_DATA)
+    for player_class, subclasses in data.items()
+    for subclass in subclasses
+    if subclass != 'Base'
+})
+
+def create_new_player(name: str, player_class: str, subclass: str, save_slot: int) -> PlayerData:
+    """Create a new player with default stats using JSON data"""
+    attributes = dict(STARTING_ATTRIBUTES.get(player_class, DEFAULT_STARTING_ATTRIBUTES))
+    loadout = STARTING_LOADOUT.get((player_class, subclass))
+    if loadout is None:
+        loadout = build_starting_loadout(player_class, subclass)
+    
+    return PlayerData(
+        name=name,
+        player_class=player_class,
+        subclass=subclass,
+        level=1,
+        spells=list(loadout['spells']),
+        weapon=loadout['weapon'],
+        inventory=[],
+        gold=0,
+        save_slot=save_slot,
+        xp=0,
+        ac=10 + attributes.get('Con', 10),
+        attributes=attributes,
+        passive=loadout['passive'],
+        hp=10 + attributes.get('Con', 10),
+        max_hp=10 + attributes.get('Con', 10)
+    )
 
 @app.post("/create_room")
 def create_room():
@@ -199,7 +520,7 @@ def create_room():
     return {"room_id": MAIN_ROOM_ID}
 
 @app.post("/join_room/{room_id}")
-def join_room(
+async def join_room(
     room_id: str,
     player: str = Query(...),
     player_class: str = Query(None),
@@ -209,39 +530,49 @@ def join_room(
 ):
     # Ignore provided room_id, always use MAIN_ROOM_ID
     room_id = MAIN_ROOM_ID
-    player = player.lower().strip()
+    # Interned names make turn checks and dict lookups pointer comparisons
+    player = sys.intern(player.lower().strip())
+    if player_class:
+        player_class = sys.intern(player_class)
+    if subclass:
+        subclass = sys.intern(subclass)
     print(f"[DEBUG] join_room called: room_id={room_id}, player={player}, class={player_class}, subclass={subclass}, save_slot={save_slot}, load_save={load_save}")
-    with room_lock:
-        if room_id not in games:
-            return {"error": "Room not found"}
-        # Load existing player data or create new player
-        if load_save:
-            player_data = load_player_data(player, save_slot)
-            if player_data:
-                games[room_id]["players"][player] = player_data
-            else:
-                return {"error": "Save file not found"}
-        else:
-            if not player_class or not subclass:
-                return {"error": "Player class and subclass required for new characters"}
-            player_data = create_new_player(player, player_class, subclass, save_slot)
+    if room_id not in games:
+        return {"error": "Room not found"}
+    # Load existing player data or create new player
+    if load_save:
+        player_data = await asyncio.to_thread(load_player_data, player, save_slot)
+        if not player_data:
+            return {"error": "Save file not found"}
+    else:
+        if not player_class or not subclass:
+            return {"error": "Player class and subclass required for new characters"}
+        player_data = create_new_player(player, player_class, subclass, save_slot)
+    # Apply the join like an action: under the room lock, then broadcast the roster
+    async with room_locks[room_id]:
+        with room_lock:
             games[room_id]["players"][player] = player_data
-        # Add to player order if not already there
-        if player not in games[room_id]["player_order"]:
-            games[room_id]["player_order"].append(player)
-        # Set turn if not set
-        if games[room_id]["state"]["turn"] is None and games[room_id]["player_order"]:
-            games[room_id]["state"]["turn"] = games[room_id]["player_order"][0]
-        # Update state with player data
-        games[room_id]["state"]["player_hp"][player] = player_data["hp"]
-        games[room_id]["state"]["inventory"][player] = player_data["inventory"]
-        games[room_id]["state"]["spells"][player] = player_data["spells"]
-        games[room_id]["state"]["gold"][player] = player_data["gold"]
-        games[room_id]["state"]["level"][player] = player_data["level"]
-        games[room_id]["state"]["xp"][player] = player_data["xp"]
-        save_rooms()
-        print(f"Player {player} joined room {room_id}. Current players: {list(games[room_id]['players'].keys())}")
-    return {"success": True, "player_data": player_data}
+            if not load_save:
+                # New characters have no save file yet
+                dirty_players[room_id].add(player)
+            # Add to player order if not already there
+            if player not in games[room_id]["player_order"]:
+                games[room_id]["player_order"].append(player)
+            # Set turn if not set
+            if games[room_id]["state"].turn is None and games[room_id]["player_order"]:
+                games[room_id]["state"].turn_idx = 0
+                games[room_id]["state"].turn = games[room_id]["player_order"][0]
+            # Update state with player data
+            games[room_id]["state"].player_hp[player] = player_data.hp
+            games[room_id]["state"].inventory[player] = player_data.inventory
+            games[room_id]["state"].spells[player] = player_data.spells
+            games[room_id]["state"].gold[player] = player_data.gold
+            games[room_id]["state"].level[player] = player_data.level
+            games[room_id]["state"].xp[player] = player_data.xp
+            mark_rooms_dirty()
+            print(f"Player {player} joined room {room_id}. Current players: {list(games[room_id]['players'].keys())}")
+        broadcast(room_id, state_delta(room_id, ROSTER_KEYS))
+    return {"success": True, "player_data": msgspec.to_builtins(player_data)}
 
 @app.get("/list_saves/{player_name}")
 def list_saves(player_name: str):
@@ -251,15 +582,14 @@ def list_saves(player_name: str):
         save_path = os.path.join(SAVE_DIR, f'save{i}_{player_name}.json')
         if os.path.exists(save_path):
             try:
-                with open(save_path, 'r') as f:
-                    data = json.load(f)
-                    saves.append({
-                        "slot": i,
-                        "name": data.get("name", "Unknown"),
-                        "level": data.get("level", 1),
-                        "player_class": data.get("player_class", "Unknown"),
-                        "subclass": data.get("subclass", "Unknown")
-                    })
+                data = read_save_file(save_path)
+                saves.append({
+                    "slot": i,
+                    "name": data.get("name", "Unknown"),
+                    "level": data.get("level", 1),
+                    "player_class": data.get("player_class", "Unknown"),
+                    "subclass": data.get("subclass", "Unknown")
+                })
             except:
                 continue
     return {"saves": saves}
@@ -290,60 +620,71 @@ def get_classes():
     
     return {"classes": classes}
 
-def generate_encounter(encounter_number: int) -> Dict:
+# Enemy stats based on type
+ENEMY_STATS = MappingProxyType({
+    'Goblin': {'hp': 30, 'attack': 8, 'ac': 11},
+    'Orc': {'hp': 50, 'attack': 12, 'ac': 13},
+    'Skeleton': {'hp': 40, 'attack': 10, 'ac': 12},
+    'Bandit': {'hp': 35, 'attack': 9, 'ac': 12},
+    'Troll': {'hp': 70, 'attack': 15, 'ac': 14},
+    'Shaman': {'hp': 35, 'attack': 6, 'ac': 12},
+    'Necromancer': {'hp': 30, 'attack': 5, 'ac': 12},
+    'Healer': {'hp': 28, 'attack': 4, 'ac': 11},
+    'Berserker': {'hp': 45, 'attack': 10, 'ac': 12},
+    'Alchemist': {'hp': 32, 'attack': 7, 'ac': 11},
+    'Witch': {'hp': 28, 'attack': 6, 'ac': 12},
+    'Sniper': {'hp': 30, 'attack': 14, 'ac': 12},
+    'Guardian': {'hp': 60, 'attack': 8, 'ac': 15},
+    'Enchanter': {'hp': 30, 'attack': 5, 'ac': 12},
+    'Dragon': {'hp': 120, 'attack': 20, 'ac': 17},
+    'Lich King': {'hp': 100, 'attack': 18, 'ac': 16},
+})
+DEFAULT_ENEMY_STATS = MappingProxyType({'hp': 30, 'attack': 8, 'ac': 11})
+
+def build_encounter_enemies(encounter: Dict) -> tuple:
+    """Build the enemy templates for an encounter from encounters.json"""
+    templates = []
+    for i, enemy_data in enumerate(encounter['enemies']):
+        enemy_type = enemy_data['type']
+        row = enemy_data['row']
+        col = enemy_data['col']
+        
+        stats = ENEMY_STATS.get(enemy_type, DEFAULT_ENEMY_STATS)
+        
+        templates.append(Enemy(
+            name=f"{enemy_type} {i+1}",
+            type=enemy_type.lower(),
+            hp=stats['hp'],
+            max_hp=stats['hp'],
+            damage=stats['attack'],
+            ac=stats['ac'],
+            position=[row, col]
+        ))
+    return tuple(templates)
+
+# Enemy templates for each encounter, copied by generate_encounter
+ENCOUNTER_ENEMIES = tuple(build_encounter_enemies(e) for e in ENCOUNTERS)
+
+# ENCOUNTERS_BY_DIFFICULTY[n] holds the enemy templates of the encounters
+# suitable for encounter n (difficulty <= n + 1); later encounters use the last bucket
+MAX_DIFFICULTY = max((e['difficulty'] for e in ENCOUNTERS), default=0)
+ENCOUNTERS_BY_DIFFICULTY = tuple(
+    tuple(
+        enemies for e, enemies in zip(ENCOUNTERS, ENCOUNTER_ENEMIES) if e['difficulty'] <= n + 1
+    ) or ENCOUNTER_ENEMIES
+    for n in range(max(MAX_DIFFICULTY, 1))
+)
+
+def generate_encounter(encounter_number: int) -> Dict[str, Enemy]:
     """Generate enemies for an encounter using encounters.json"""
     enemies = {}
     
-    # Load encounters from JSON file
-    encounters = load_json_data('encounters.json')
-    
-    if encounters:
-        # Find appropriate encounter based on difficulty
-        suitable_encounters = [e for e in encounters if e['difficulty'] <= encounter_number + 1]
-        if not suitable_encounters:
-            suitable_encounters = encounters
-        
-        # Pick a random suitable encounter
-        encounter = random.choice(suitable_encounters)
-        
-        # Convert encounter enemies to game format
-        for i, enemy_data in enumerate(encounter['enemies']):
-            enemy_type = enemy_data['type']
-            row = enemy_data['row']
-            col = enemy_data['col']
-            
-            # Enemy stats based on type
-            enemy_stats = {
-                'Goblin': {'hp': 30, 'attack': 8, 'ac': 11},
-                'Orc': {'hp': 50, 'attack': 12, 'ac': 13},
-                'Skeleton': {'hp': 40, 'attack': 10, 'ac': 12},
-                'Bandit': {'hp': 35, 'attack': 9, 'ac': 12},
-                'Troll': {'hp': 70, 'attack': 15, 'ac': 14},
-                'Shaman': {'hp': 35, 'attack': 6, 'ac': 12},
-                'Necromancer': {'hp': 30, 'attack': 5, 'ac': 12},
-                'Healer': {'hp': 28, 'attack': 4, 'ac': 11},
-                'Berserker': {'hp': 45, 'attack': 10, 'ac': 12},
-                'Alchemist': {'hp': 32, 'attack': 7, 'ac': 11},
-                'Witch': {'hp': 28, 'attack': 6, 'ac': 12},
-                'Sniper': {'hp': 30, 'attack': 14, 'ac': 12},
-                'Guardian': {'hp': 60, 'attack': 8, 'ac': 15},
-                'Enchanter': {'hp': 30, 'attack': 5, 'ac': 12},
-                'Dragon': {'hp': 120, 'attack': 20, 'ac': 17},
-                'Lich King': {'hp': 100, 'attack': 18, 'ac': 16},
-            }
-            
-            stats = enemy_stats.get(enemy_type, {'hp': 30, 'attack': 8, 'ac': 11})
-            
-            enemy = {
-                "name": f"{enemy_type} {i+1}",
-                "type": enemy_type.lower(),
-                "hp": stats['hp'],
-                "max_hp": stats['hp'],
-                "damage": stats['attack'],
-                "ac": stats['ac'],
-                "position": [row, col]
-            }
-            enemies[enemy["name"]] = enemy
+    if ENCOUNTER_ENEMIES:
+        # Pick a random encounter from the bucket for this difficulty
+        suitable_encounters = ENCOUNTERS_BY_DIFFICULTY[min(encounter_number, len(ENCOUNTERS_BY_DIFFICULTY) - 1)]
+        # Copy the templates: combat changes hp on the room's own enemies
+        for template in random.choice(suitable_encounters):
+            enemies[template.name] = msgspec.structs.replace(template, position=list(template.position))
     else:
         # Fallback to original generation
         enemy_types = ["Goblin", "Orc", "Troll", "Dragon"]
@@ -351,208 +692,343 @@ def generate_encounter(encounter_number: int) -> Dict:
         
         for i in range(num_enemies):
             enemy_type = random.choice(enemy_types)
-            enemy = {
-                "name": f"{enemy_type} {i+1}",
-                "type": enemy_type,
-                "hp": 20 + (encounter_number * 5),
-                "max_hp": 20 + (encounter_number * 5),
-                "damage": 5 + encounter_number,
-                "ac": 12 + encounter_number,
-                "position": [random.randint(0, 5), random.randint(0, 5)]
-            }
-            enemies[enemy["name"]] = enemy
+            enemy = Enemy(
+                name=f"{enemy_type} {i+1}",
+                type=enemy_type,
+                hp=20 + (encounter_number * 5),
+                max_hp=20 + (encounter_number * 5),
+                damage=5 + encounter_number,
+                ac=12 + encounter_number,
+                position=[random.randint(0, 5), random.randint(0, 5)]
+            )
+            enemies[enemy.name] = enemy
     
     return enemies
 
-def generate_shop_items() -> List[Dict]:
-    """Generate shop items"""
-    items = [
-        {"name": "Health Potion", "cost": 50, "type": "consumable", "effect": "heal"},
-        {"name": "Mana Potion", "cost": 50, "type": "consumable", "effect": "mana"},
-        {"name": "Iron Sword", "cost": 100, "type": "weapon", "damage": 8},
-        {"name": "Leather Armor", "cost": 80, "type": "armor", "ac": 2},
-        {"name": "Magic Ring", "cost": 200, "type": "accessory", "effect": "buff"}
-    ]
-    return random.sample(items, 3)
-
-def generate_loot() -> List[Dict]:
-    """Generate loot pool"""
-    loot = [
-        {"name": "Gold", "amount": random.randint(10, 50)},
-        {"name": "Health Potion", "type": "consumable"},
-        {"name": "Magic Scroll", "type": "spell"},
-        {"name": "Gem", "value": random.randint(20, 100)}
+SHOP_ITEMS = (
+    {"name": "Health Potion", "cost": 50, "type": "consumable", "effect": "heal"},
+    {"name": "Mana Potion", "cost": 50, "type": "consumable", "effect": "mana"},
+    {"name": "Iron Sword", "cost": 100, "type": "weapon", "damage": 8},
+    {"name": "Leather Armor", "cost": 80, "type": "armor", "ac": 2},
+    {"name": "Magic Ring", "cost": 200, "type": "accessory", "effect": "buff"}
+)
+
+def generate_shop_items() -> Dict[str, Dict]:
+    """Generate shop items, keyed by name"""
+    # Copy the templates: bought items end up in player inventories
+    return {item["name"]: dict(item) for item in random.sample(SHOP_ITEMS, 3)}
+
+# Loot templates; LOOT_ROLLS lists the (key, low, high) rolled when an item drops
+LOOT_TABLE = (
+    {"name": "Gold"},
+    {"name": "Health Potion", "type": "consumable"},
+    {"name": "Magic Scroll", "type": "spell"},
+    {"name": "Gem"}
+)
+LOOT_ROLLS = MappingProxyType({
+    "Gold": ("amount", 10, 50),
+    "Gem": ("value", 20, 100),
+})
+
+def generate_loot() -> Dict[str, Dict]:
+    """Generate loot pool, keyed by name"""
+    loot = {}
+    for template in random.sample(LOOT_TABLE, 2):
+        item = dict(template)
+        if item["name"] in LOOT_ROLLS:
+            key, low, high = LOOT_ROLLS[item["name"]]
+            item[key] = random.randint(low, high)
+        loot[item["name"]] = item
+    return loot
+
+# Ranges batch-drawn with random.choices: player start cells and post-combat gold
+START_AREA = range(3)
+GOLD_REWARD = range(10, 31)
+
+# Action handlers: each applies one action type to the room's state in place
+# and adds the top-level state keys it changed to `changed`
+async def handle_move(room_id: str, room: Dict, player: str, action: Dict, changed: Set[str]):
+    """Move the player one cell, clamped to the board"""
+    state = room["state"]
+    direction = action["move"]
+    if not isinstance(direction, str):
+        # Not a direction name (and maybe unhashable): treat as a no-op
+        return
+    dx, dy = MOVES.get(direction, (0, 0))
+    x, y = state.player_positions.get(player, [0, 0])
+    position = [
+        min(GRID_MAX, max(0, x + dx)),
+        min(GRID_MAX, max(0, y + dy))
     ]
-    return random.sample(loot, 2)
+    if state.player_positions.get(player) != position:
+        state.player_positions[player] = position
+        changed.add("player_positions")
+
+async def handle_attack(room_id: str, room: Dict, player: str, action: Dict, changed: Set[str]):
+    """Melee attack an enemy"""
+    state = room["state"]
+    target = action["attack"]
+    if isinstance(target, str) and target in state.enemies:
+        enemy = state.enemies[target]
+        damage = random.randint(5, 15)
+        enemy.hp -= damage
+        if enemy.hp <= 0:
+            del state.enemies[target]
+        changed.add("enemies")
+
+async def handle_spell(room_id: str, room: Dict, player: str, action: Dict, changed: Set[str]):
+    """Cast a healing or damage spell"""
+    state = room["state"]
+    spell = action["spell"]
+    target = action.get("target")
+    # Handle spell effects (simplified)
+    if spell in ["Healing Word", "Cure Wounds"]:
+        heal_amount = random.randint(10, 20)
+        state.player_hp[player] = min(
+            state.player_hp[player] + heal_amount,
+            room["players"][player].max_hp
+        )
+        dirty_players[room_id].add(player)
+        changed.add("player_hp")
+    elif spell in ["Fireball", "Magic Missile"] and isinstance(target, str):
+        enemy = state.enemies.get(target)
+        if enemy is not None:
+            damage = random.randint(15, 25)
+            enemy.hp -= damage
+            if enemy.hp <= 0:
+                del state.enemies[target]
+            changed.add("enemies")
+
+async def handle_shop(room_id: str, room: Dict, player: str, action: Dict, changed: Set[str]):
+    """Buy a shop item if the player can afford it"""
+    state = room["state"]
+    item_name = action["shop"]
+    # Non-str names (maybe unhashable) match nothing
+    item = state.shop_items.get(item_name) if isinstance(item_name, str) else None
+    if item is not None and state.gold[player] >= item["cost"]:
+        state.gold[player] -= item["cost"]
+        state.inventory[player].append(item)
+        dirty_players[room_id].add(player)
+        changed.update(("gold", "inventory"))
+
+async def handle_loot(room_id: str, room: Dict, player: str, action: Dict, changed: Set[str]):
+    """Take an item from the loot pool"""
+    state = room["state"]
+    item_name = action["loot"]
+    item = state.loot_pool.pop(item_name, None) if isinstance(item_name, str) else None
+    if item is not None:
+        state.inventory[player].append(item)
+        dirty_players[room_id].add(player)
+        changed.update(("inventory", "loot_pool"))
+
+async def handle_next_phase(room_id: str, room: Dict, player: str, action: Dict, changed: Set[str]):
+    """Advance setup -> combat -> loot -> shop -> setup"""
+    state = room["state"]
+    order = room["player_order"]
+    current_phase = state.phase
+    if current_phase == "setup":
+        # Start combat
+        state.phase = "combat"
+        state.encounter_number += 1
+        state.enemies = generate_encounter(state.encounter_number)
+        # Position players randomly, drawing every coordinate in one call
+        coords = random.choices(START_AREA, k=2 * len(order))
+        for i, p in enumerate(order):
+            state.player_positions[p] = coords[2 * i:2 * i + 2]
+        changed.update(("phase", "encounter_number", "enemies", "player_positions"))
+
+    elif current_phase == "combat":
+        # Check if combat is over
+        if not state.enemies:
+            state.phase = "loot"
+            state.loot_pool = generate_loot()
+            # Award XP and gold
+            rewards = random.choices(GOLD_REWARD, k=len(order))
+            for p, reward in zip(order, rewards):
+                state.xp[p] += 100
+                state.gold[p] += reward
+            dirty_players[room_id].update(order)
+            changed.update(("phase", "loot_pool", "xp", "gold"))
+
+    elif current_phase == "loot":
+        state.phase = "shop"
+        state.shop_items = generate_shop_items()
+        changed.update(("phase", "shop_items"))
+
+    elif current_phase == "shop":
+        state.phase = "setup"
+        changed.add("phase")
+        # Save players whose progress changed, in parallel worker threads
+        dirty = dirty_players[room_id]
+        saved = [p for p in order if p in dirty]
+        saves = []
+        for p in saved:
+            player_data = msgspec.structs.replace(
+                room["players"][p],
+                hp=state.player_hp[p],
+                inventory=state.inventory[p],
+                gold=state.gold[p],
+                xp=state.xp[p]
+            )
+            saves.append(asyncio.to_thread(save_player_data, p, player_data.save_slot, player_data))
+        results = await asyncio.gather(*saves, return_exceptions=True)
+        # Only clear players whose write landed; failed ones retry next shop phase
+        for p, result in zip(saved, results):
+            if isinstance(result, Exception):
+                print(f"Failed to save player {p}: {result}")
+            else:
+                dirty.discard(p)
+
+def echo_action(action_type: str, action: Dict) -> Dict:
+    """The dispatched part of an action, as echoed to everyone in last_action"""
+    keys = (action_type, "target") if action_type == "spell" else (action_type,)
+    # Only plain values: client maps may hold non-str keys the JSON encoder rejects
+    return {
+        key: action[key] if isinstance(action.get(key), (str, bool)) else None
+        for key in keys
+    }
+
+# Checked in this order; a message carrying several action types runs only the first
+ACTION_HANDLERS = MappingProxyType({
+    "move": handle_move,
+    "attack": handle_attack,
+    "spell": handle_spell,
+    "shop": handle_shop,
+    "loot": handle_loot,
+    "next_phase": handle_next_phase,
+})
 
 @app.websocket("/ws/{room_id}/{player}")
-async def websocket_endpoint(websocket: WebSocket, room_id: str, player: str):
+async def websocket_endpoint(
+    websocket: WebSocket,
+    room_id: str,
+    player: str,
+    wire_format: str = Query("msgpack", alias="format")
+):
     # Ignore provided room_id, always use MAIN_ROOM_ID
     room_id = MAIN_ROOM_ID
-    player = player.lower().strip()
-    await websocket.accept()  # Accept first, then validate
+    player = sys.intern(player.lower().strip())
     print(f"[DEBUG] WebSocket connect attempt: room_id={room_id}, player={player}")
     print(f"[DEBUG] Current rooms: {list(games.keys())}")
     if room_id in games:
         print(f"[DEBUG] Players in room: {list(games[room_id]['players'].keys())}")
     with room_lock:
-        if room_id not in games or player not in games[room_id]["players"]:
-            error = f"Rejected: Room {room_id} or Player {player} not found"
-            print(f"[DEBUG] {error}")
-            await websocket.send_text(json.dumps({"error": error}))
-            await websocket.close()
-            return
+        valid = room_id in games and player in games[room_id]["players"]
+    if not valid:
+        # Closing before accept rejects the handshake (HTTP 403) without upgrading
+        print(f"[DEBUG] Rejected: Room {room_id} or Player {player} not found")
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    channel = Channel(websocket, wire_format)
     try:
+        # Tell everyone else about the new player, then sync the new connection
+        async with room_locks[room_id]:
+            broadcast(room_id, state_delta(room_id, ROSTER_KEYS))
+            connections.setdefault(room_id, set()).add(channel)
+            channel.send(encode_message(full_state(room_id), wire_format))
+        bucket = TokenBucket(ACTION_RATE, ACTION_BURST)
         while True:
-            # Send current game state
-            state = games[room_id]["state"].copy()
-            state["players"] = games[room_id]["players"]
-            state["player_order"] = games[room_id]["player_order"]
-            await websocket.send_text(json.dumps(state))
-            
             # Wait for action from player
-            if state["turn"] == player:
-                data = await websocket.receive_text()
-                action_data = json.loads(data)
+            await bucket.acquire()
+            action_data = await receive_message(websocket, wire_format)
+            if action_data is None:
+                # Oversized or malformed message, dropped
+                continue
+            if action_data.get("sync"):
+                # Resend the snapshot to this client only; does not use a turn
+                async with room_locks[room_id]:
+                    channel.resync(encode_message(full_state(room_id), wire_format))
+                continue
+            async with room_locks[room_id]:
+                room = games[room_id]
+                order = room["player_order"]
+                state = room["state"]
+                if state.turn != player:
+                    # Not this player's turn, ignore the action
+                    continue
                 action = action_data.get("action", {})
-                
-                # Handle different action types
-                if "move" in action:
-                    direction = action["move"]
-                    current_pos = state["player_positions"].get(player, [0, 0])
-                    new_pos = current_pos.copy()
-                    
-                    if direction == "up" and new_pos[1] > 0:
-                        new_pos[1] -= 1
-                    elif direction == "down" and new_pos[1] < 5:
-                        new_pos[1] += 1
-                    elif direction == "left" and new_pos[0] > 0:
-                        new_pos[0] -= 1
-                    elif direction == "right" and new_pos[0] < 5:
-                        new_pos[0] += 1
-                    
-                    state["player_positions"][player] = new_pos
-                
-                elif "attack" in action:
-                    target = action["attack"]
-                    if target in state["enemies"]:
-                        enemy = state["enemies"][target]
-                        damage = random.randint(5, 15)
-                        enemy["hp"] -= damage
-                        if enemy["hp"] <= 0:
-                            del state["enemies"][target]
-                
-                elif "spell" in action:
-                    spell = action["spell"]
-                    target = action.get("target")
-                    # Handle spell effects (simplified)
-                    if spell in ["Healing Word", "Cure Wounds"]:
-                        heal_amount = random.randint(10, 20)
-                        state["player_hp"][player] = min(
-                            state["player_hp"][player] + heal_amount,
-                            games[room_id]["players"][player]["max_hp"]
-                        )
-                    elif spell in ["Fireball", "Magic Missile"]:
-                        if target in state["enemies"]:
-                            damage = random.randint(15, 25)
-                            state["enemies"][target]["hp"] -= damage
-                            if state["enemies"][target]["hp"] <= 0:
-                                del state["enemies"][target]
-                
-                elif "shop" in action:
-                    item_name = action["shop"]
-                    player_gold = state["gold"][player]
-                    for item in state["shop_items"]:
-                        if item["name"] == item_name and player_gold >= item["cost"]:
-                            state["gold"][player] -= item["cost"]
-                            state["inventory"][player].append(item)
-                            break
-                
-                elif "loot" in action:
-                    item_name = action["loot"]
-                    for item in state["loot_pool"]:
-                        if item["name"] == item_name:
-                            state["inventory"][player].append(item)
-                            state["loot_pool"].remove(item)
-                            break
-                
-                elif "next_phase" in action:
-                    current_phase = state["phase"]
-                    if current_phase == "setup":
-                        # Start combat
-                        state["phase"] = "combat"
-                        state["encounter_number"] += 1
-                        state["enemies"] = generate_encounter(state["encounter_number"])
-                        # Position players randomly
-                        for p in games[room_id]["player_order"]:
-                            state["player_positions"][p] = [random.randint(0, 2), random.randint(0, 2)]
-                    
-                    elif current_phase == "combat":
-                        # Check if combat is over
-                        if not state["enemies"]:
-                            state["phase"] = "loot"
-                            state["loot_pool"] = generate_loot()
-                            # Award XP and gold
-                            for p in games[room_id]["player_order"]:
-                                state["xp"][p] += 100
-                                state["gold"][p] += random.randint(10, 30)
-                    
-                    elif current_phase == "loot":
-                        state["phase"] = "shop"
-                        state["shop_items"] = generate_shop_items()
-                    
-                    elif current_phase == "shop":
-                        state["phase"] = "setup"
-                        # Save all players
-                        for p in games[room_id]["player_order"]:
-                            player_data = games[room_id]["players"][p].copy()
-                            player_data.update({
-                                "hp": state["player_hp"][p],
-                                "inventory": state["inventory"][p],
-                                "gold": state["gold"][p],
-                                "xp": state["xp"][p]
-                            })
-                            save_player_data(p, player_data["save_slot"], player_data)
-                
+                if not isinstance(action, dict):
+                    continue
+                # Top-level state keys this action changes
+                changed = set()
+            
+                # Run the handler for the first action type present
+                last_action = {}
+                for action_type, handler in ACTION_HANDLERS.items():
+                    if action_type in action:
+                        last_action = echo_action(action_type, action)
+                        await handler(room_id, room, player, action, changed)
+                        break
+            
                 # Move to next player's turn
-                current_turn_index = games[room_id]["player_order"].index(state["turn"])
-                next_turn_index = (current_turn_index + 1) % len(games[room_id]["player_order"])
-                state["turn"] = games[room_id]["player_order"][next_turn_index]
-                
-                # Update game state
-                games[room_id]["state"] = state
-                save_rooms()
-                
+                turn_idx = (state.turn_idx + 1) % len(order)
+                if turn_idx != state.turn_idx:
+                    state.turn_idx = turn_idx
+                    state.turn = order[turn_idx]
+                    changed.update(("turn", "turn_idx"))
+            
                 # Check for game over conditions
-                if not state["enemies"] and state["phase"] == "combat":
-                    state["winner"] = "Players"
-                
+                if not state.enemies and state.phase == "combat" and state.winner != "Players":
+                    state.winner = "Players"
+                    changed.add("winner")
+            
                 # Check if all players are dead
-                alive_players = [p for p in games[room_id]["player_order"] 
-                               if state["player_hp"].get(p, 0) > 0]
-                if not alive_players and state["phase"] == "combat":
-                    state["winner"] = "Enemies"
+                alive_players = [p for p in order
+                               if state.player_hp.get(p, 0) > 0]
+                if not alive_players and state.phase == "combat" and state.winner != "Enemies":
+                    state.winner = "Enemies"
+                    changed.add("winner")
             
-            else:
-                # Wait for other player's turn
-                await asyncio.sleep(1)
-                
+                # Nothing changed (e.g. a solo player walking into a wall): no save, no send
+                if not changed:
+                    continue
+                # State was mutated in place; just schedule a save
+                mark_rooms_dirty()
+                broadcast(room_id, state_delta(room_id, changed, {"player": player, "action": last_action}))
+        
     except WebSocketDisconnect:
-        # Remove player from game
-        with room_lock:
-            if room_id in games and player in games[room_id]["player_order"]:
-                games[room_id]["player_order"].remove(player)
-                if player in games[room_id]["players"]:
-                    del games[room_id]["players"][player]
+        pass
+    finally:
+        # Runs on every exit, so a crashed handler never leaves a ghost player holding the turn
+        channel.close()
+        if room_id in connections:
+            connections[room_id].discard(channel)
+        async with room_locks[room_id]:
+            # Remove player from game
+            with room_lock:
+                if room_id in games and player in games[room_id]["player_order"]:
+                    order = games[room_id]["player_order"]
+                    state = games[room_id]["state"]
+                    left_index = order.index(player)
+                    del order[left_index]
+                    if player in games[room_id]["players"]:
+                        del games[room_id]["players"][player]
                 
-                # Update turn if needed
-                if games[room_id]["state"]["turn"] == player:
-                    if games[room_id]["player_order"]:
-                        games[room_id]["state"]["turn"] = games[room_id]["player_order"][0]
+                    # Keep turn_idx on the same player, or pass the turn on
+                    # to whoever followed the leaving player
+                    if left_index < state.turn_idx:
+                        state.turn_idx -= 1
+                    if order:
+                        state.turn_idx %= len(order)
+                        state.turn = order[state.turn_idx]
                     else:
-                        games[room_id]["state"]["turn"] = None
-                save_rooms()
+                        state.turn_idx = 0
+                        state.turn = None
+                    mark_rooms_dirty()
+            broadcast(room_id, state_delta(room_id, ROSTER_KEYS))
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000) 
+    # uvloop event loop and httptools parser come with uvicorn[standard]
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        ws_max_size=MAX_MESSAGE_SIZE,
+        # Compress frames with a sliding window kept across messages
+        ws_per_message_deflate=True
+    )